@@ -1,115 +1,48 @@
 import subprocess
-import re
 import sys
+import threading
+import time
+from bisect import bisect_right
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, 
     QHBoxLayout, QLabel, QSlider, QPushButton, QLineEdit, QGridLayout, QMessageBox
 )
 from PyQt6.QtGui import QIntValidator
-from PyQt6.QtCore import Qt, QTimer, QLocale
+from PyQt6.QtCore import Qt, QTimer, QLocale, QRunnable, QThreadPool
 
-# --- Core Kelvin to RGB Gamma Conversion Logic (Preserved from original script) ---
+from pylux_core import (
+    kelvin_to_rgb_gamma, get_connected_displays, init_randr, format_gamma, apply_gamma
+)
 
-def kelvin_to_rgb_gamma(temp_k):
-    """
-    Converts a color temperature in Kelvin (K) to R, G, B gamma correction values
-    suitable for the 'xrandr --gamma R:G:B' command.
+# Resolution of the fade; steps whose gamma string repeats are not replayed
+FADE_STEPS = 100
 
-    This uses a simplified, practical algorithm derived from the Planckian Locus 
-    to create a smooth transition from cool (daylight) to warm (night light) 
-    colors, optimized for the screen's gamma ramp (0.0 to 1.0).
+# Minimum seconds between label refreshes during a fade (~30 Hz)
+UI_UPDATE_INTERVAL_S = 0.033
 
-    Args:
-        temp_k (int/float): The desired color temperature in Kelvin (e.g., 6500, 3000).
 
-    Returns:
-        tuple: (red_gamma, green_gamma, blue_gamma) as floats between 0.0 and 1.0.
-    """
-    temp_k = float(temp_k)
+def temperature_label(temp_k, r, g, b):
+    """Builds the text of the 'Current Temp' label."""
+    return f"Current Temp: {int(temp_k)}K (Gamma: {r:.2f}:{g:.2f}:{b:.2f})"
 
-    # Clamp the temperature to a practical range for screen correction
-    min_k = 1000.0
-    max_k = 6500.0
-    
-    if temp_k >= max_k:
-        return 1.0, 1.0, 1.0
-    if temp_k <= min_k:
-        temp_k = min_k # Ensure the calculation doesn't fail below min
-
-    # --- Red Gamma Calculation (Red is clamped high for the warming effect) ---
-    red = 1.0
-
-    # --- Green Gamma Calculation ---
-    if temp_k >= 5000.0:
-        # Linear fade from 1.0 at 6500K to ~0.9 at 5000K
-        green = 0.8 + 0.2 * ((temp_k - 5000.0) / 1500.0)
-    elif temp_k >= 2000.0:
-        # Linear fade from ~0.9 at 5000K to ~0.6 at 2000K
-        green = 0.6 + 0.3 * ((temp_k - 2000.0) / 3000.0)
-    else:
-        # Below 2000K, clamp near min
-        green = 0.6 - 0.1 * ((2000.0 - temp_k) / 1000.0)
-    
-    green = max(0.5, min(1.0, green)) # Clamp between 0.5 and 1.0
-
-    # --- Blue Gamma Calculation (Blue drops most significantly) ---
-    if temp_k >= 6000.0:
-        # Linear fade from 1.0 at 6500K to 0.9 at 6000K
-        blue = 0.8 + 0.2 * ((temp_k - 6000.0) / 500.0)
-    elif temp_k >= 3000.0:
-        # Linear fade from ~0.8 at 6000K to ~0.3 at 3000K
-        blue = 0.3 + 0.5 * ((temp_k - 3000.0) / 3000.0)
-    else:
-        # Below 3000K, clamp near min
-        blue = 0.3 * ((temp_k - 1000.0) / 2000.0)
-        
-    blue = max(0.0, min(1.0, blue)) # Clamp between 0.0 and 1.0
-    
-    return red, green, blue
 
+# --- Background Gamma Application ---
 
-# --- Utility Functions for xrandr Interaction (Preserved) ---
+class ApplyGammaTask(QRunnable):
+    """Runs a batched xrandr gamma apply on a worker thread."""
 
-def get_connected_displays():
-    """
-    Uses xrandr to find all connected display names (e.g., 'eDP-1', 'HDMI-A-1').
-    """
-    try:
-        # Run xrandr to get display information
-        result = subprocess.run(['xrandr'], capture_output=True, text=True, check=True)
-        output = result.stdout
-        
-        # Regex to find lines with 'connected' and extract the display name
-        connected_displays = re.findall(r'^(\S+)\s+connected', output, re.MULTILINE)
-        
-        if not connected_displays:
-            return None
-        return connected_displays
-    
-    except FileNotFoundError:
-        return 'XRANDR_NOT_FOUND'
-    except subprocess.CalledProcessError:
-        return 'XRANDR_ERROR'
-    except Exception:
-        return 'UNKNOWN_ERROR'
-
-def apply_gamma(display, r, g, b):
-    """
-    Applies the given R:G:B gamma values to a specific display using xrandr.
-    """
-    gamma_value = f"{r:.4f}:{g:.4f}:{b:.4f}"
-    cmd = ['xrandr', '--output', display, '--gamma', gamma_value]
-    
-    try:
-        # Execute the xrandr command
-        subprocess.run(cmd, check=True, capture_output=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to set gamma for {display}. Error: {e.stderr.decode().strip()}")
-        return False
-    except Exception as e:
-        print(f"An unexpected error occurred while setting gamma for {display}: {e}")
-        return False
+    def __init__(self, displays, gamma_value, on_done):
+        super().__init__()
+        self.displays = displays
+        self.gamma_value = gamma_value
+        self.on_done = on_done
+
+    def run(self):
+        applied = False
+        try:
+            applied = apply_gamma(self.displays, self.gamma_value)
+        finally:
+            self.on_done(self.gamma_value, applied)
 
 
 # --- PyQt Application Class ---
@@ -133,14 +66,30 @@ class PyFluxApp(QMainWindow):
             )
             return
 
+        init_randr(self.displays)
+
         # State Variables
         self.current_temp = 6500
         self.transition_timer = QTimer(self)
+        self.transition_timer.setTimerType(Qt.TimerType.PreciseTimer)
         self.transition_timer.timeout.connect(self._transition_step)
         self.start_temp = 0
         self.end_temp = 0
         self.steps = 0
         self.current_step = 0
+        self._t0 = 0.0 # time.monotonic() at the start of the fade
+        self._dur_s = 0
+        self._last_ui_update = 0.0 # time.monotonic() of the last fade label refresh
+        self._precomputed = [] # (fade step, temp_k, gamma, temp label, status label) per distinct state
+        self._step_starts = [] # Fade step of each entry in self._precomputed
+        self._last_gamma_str = None # Last gamma string sent to xrandr (cleared if it failed)
+
+        # Fade steps run xrandr off the GUI thread. A single worker keeps the
+        # applies in order; ticks are dropped while the worker is backed up.
+        self._gamma_pool = QThreadPool(self)
+        self._gamma_pool.setMaxThreadCount(1)
+        self._pending_gamma_tasks = 0
+        self._pending_lock = threading.Lock()
 
         self.setWindowTitle("Py-Lux: Screen Color Adjuster")
         self.setMinimumWidth(400)
@@ -267,22 +216,67 @@ class PyFluxApp(QMainWindow):
         Calculates gamma for a given Kelvin temperature and applies it to all displays.
         Updates the UI label with the result.
         """
+        r, g, b = self._apply_only(temp_k)
+        self._update_temperature_ui(temp_k, temperature_label(temp_k, r, g, b))
+        return r, g, b
+
+    def _apply_only(self, temp_k):
+        """
+        Calculates gamma for a given Kelvin temperature and applies it to the
+        cached display list, without touching any widgets.
+        """
         r, g, b = kelvin_to_rgb_gamma(temp_k)
-        
-        for display in self.displays:
-            apply_gamma(display, r, g, b)
-        
-        # Update the UI
-        gamma_str = f"{r:.2f}:{g:.2f}:{b:.2f}"
-        self.temp_label.setText(f"Current Temp: {int(temp_k)}K (Gamma: {gamma_str})")
+        self._apply_gamma(r, g, b)
+        return r, g, b
+
+    def _apply_gamma(self, r, g, b, force=False):
+        """
+        Applies gamma to the cached displays, skipping the xrandr call when the
+        formatted value matches the one applied last.
+        """
+        gamma_value = format_gamma(r, g, b)
+        # Let queued fade steps land first so they can't overwrite this value,
+        # and so a failed one is no longer recorded as applied
+        self._gamma_pool.waitForDone()
+        if gamma_value == self._last_gamma_str and not force:
+            return
+        if apply_gamma(self.displays, gamma_value):
+            self._last_gamma_str = gamma_value
+
+    def _apply_gamma_async(self, gamma_value, force=False):
+        """
+        Queues a preformatted gamma apply on the worker thread. The tick is
+        skipped if the value is unchanged, or if the worker already has a task
+        queued behind the running one (unless force is set).
+        """
+        if gamma_value == self._last_gamma_str:
+            return
+        with self._pending_lock:
+            if self._pending_gamma_tasks > 1 and not force:
+                return
+            self._pending_gamma_tasks += 1
+            self._last_gamma_str = gamma_value
+        self._gamma_pool.start(ApplyGammaTask(self.displays, gamma_value, self._gamma_task_done))
+
+    def _gamma_task_done(self, gamma_value, applied):
+        """
+        Called from the worker thread when an ApplyGammaTask finishes. A failed
+        value is forgotten (unless a newer one was queued since) so it is retried.
+        """
+        with self._pending_lock:
+            self._pending_gamma_tasks -= 1
+            if not applied and self._last_gamma_str == gamma_value:
+                self._last_gamma_str = None
+
+    def _update_temperature_ui(self, temp_k, label_text):
+        """Updates the temperature label and slider to reflect an applied value."""
+        self.temp_label.setText(label_text)
         self.current_temp = int(temp_k)
         
         # Keep the slider in sync with the applied value
         self.slider.blockSignals(True)
         self.slider.setValue(int(temp_k))
         self.slider.blockSignals(False)
-        
-        return r, g, b
 
     def reset_all_displays(self):
         """
@@ -294,8 +288,7 @@ class PyFluxApp(QMainWindow):
             self.fade_button.setText("Start Transition")
             self.transition_status_label.setText("Transition interrupted and reset.")
 
-        for display in self.displays:
-            apply_gamma(display, 1.0, 1.0, 1.0)
+        self._apply_gamma(1.0, 1.0, 1.0, force=True)
             
         self.current_temp = 6500
         self.temp_label.setText(f"Current Temp: 6500K (Gamma: 1.00:1.00:1.00)")
@@ -337,41 +330,88 @@ class PyFluxApp(QMainWindow):
             )
             return
 
-        # Setup for the timer
-        self.steps = 100 # Total steps for the transition
+        # The validator still lets an intermediate value like "0" through
+        if not (1 <= duration_s <= 3600):
+            self._show_message_box(
+                "Input Error",
+                "Duration must be between 1 and 3600 seconds.",
+                QMessageBox.Icon.Warning
+            )
+            return
+
+        # Precompute the whole trajectory, including the gamma and label strings,
+        # so each tick is just a lookup + apply. Consecutive steps that format to
+        # the same xrandr gamma are merged, as replaying them would not change
+        # the screen.
+        states = []
+        last_gamma = None
+        for fade_step in range(FADE_STEPS + 1):
+            temp = int(self.start_temp + (self.end_temp - self.start_temp) * fade_step / FADE_STEPS)
+            r, g, b = kelvin_to_rgb_gamma(temp)
+            gamma_value = format_gamma(r, g, b)
+            if gamma_value != last_gamma or fade_step == FADE_STEPS:
+                states.append((fade_step, temp, gamma_value, r, g, b))
+                last_gamma = gamma_value
+
+        # Setup for the timer: one tick per distinct state
+        self.steps = len(states) - 1 # Entry 0 is the starting state
+        self._precomputed = [
+            (fade_step, temp, gamma_value, temperature_label(temp, r, g, b),
+             f"Step {step}/{self.steps}: {temp}K (Gamma: {r:.2f}:{g:.2f}:{b:.2f})")
+            for step, (fade_step, temp, gamma_value, r, g, b) in enumerate(states)
+        ]
+        self._step_starts = [entry[0] for entry in self._precomputed]
         self.current_step = 0
-        interval_ms = int((duration_s * 1000) / self.steps) # Milliseconds per step
+        interval_ms = max(1, int((duration_s * 1000) / self.steps)) # Milliseconds per step
+
+        # Apply the starting state right away; ticks only apply later states
+        _, start_temp, start_gamma, start_text, _ = self._precomputed[0]
+        self._apply_gamma_async(start_gamma)
+        self._update_temperature_ui(start_temp, start_text)
         
-        # Start the timer
+        # Start the timer; progress is derived from elapsed time, not tick count
+        self._t0 = time.monotonic()
+        self._dur_s = duration_s
+        self._last_ui_update = 0.0
         self.transition_timer.start(interval_ms)
         self.fade_button.setText("Cancel Transition")
         self.transition_status_label.setText(f"Transitioning from {self.start_temp}K to {self.end_temp}K...")
 
     def _transition_step(self):
-        """Executed by the QTimer at each step of the transition."""
-        self.current_step += 1
-        
-        if self.current_step > self.steps:
+        """
+        Executed by the QTimer at each step of the transition. The step is
+        derived from the elapsed time, so a slow tick catches up instead of
+        stretching the fade.
+        """
+        now = time.monotonic()
+        elapsed = now - self._t0
+        ratio = elapsed / self._dur_s
+        finished = ratio >= 1.0
+
+        # Latest distinct state whose fade step has been reached
+        fade_step = min(FADE_STEPS, int(ratio * FADE_STEPS))
+        step = self.steps if finished else bisect_right(self._step_starts, fade_step) - 1
+
+        if step != self.current_step:
+            self.current_step = step
+            _, current_temp, gamma_value, temp_text, status_text = self._precomputed[step]
+            
+            # Apply to the displays cached at startup without blocking the GUI;
+            # the final step is never dropped
+            self._apply_gamma_async(gamma_value, force=finished)
+
+            # Throttle widget refreshes independently of the gamma rate
+            # (always refreshing on the last step)
+            if now - self._last_ui_update >= UI_UPDATE_INTERVAL_S or finished:
+                self._last_ui_update = now
+                self._update_temperature_ui(current_temp, temp_text)
+                self.transition_status_label.setText(status_text)
+
+        if finished:
             # Transition complete
             self.transition_timer.stop()
             self.fade_button.setText("Start Transition")
             self.transition_status_label.setText("Transition complete.")
-            return
-
-        # Calculate interpolation ratio (0.0 to 1.0)
-        ratio = self.current_step / self.steps
-        
-        # Calculate the current temperature using linear interpolation
-        current_temp_f = self.start_temp + (self.end_temp - self.start_temp) * ratio
-        current_temp = int(current_temp_f)
-        
-        # Apply and update UI
-        r, g, b = self.set_all_displays_temperature(current_temp)
-
-        # Update transition status label
-        self.transition_status_label.setText(
-            f"Step {self.current_step}/{self.steps}: {current_temp}K (Gamma: {r:.2f}:{g:.2f}:{b:.2f})"
-        )
 
 
 if __name__ == '__main__':
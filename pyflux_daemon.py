@@ -1,12 +1,13 @@
-import subprocess
-import re
+import os
 import sys
 import time
 from datetime import datetime, timedelta
-from dateutil import tz 
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from astral import LocationInfo
 from astral.sun import sun
 
+from pylux_core import kelvin_to_rgb_gamma, get_connected_displays, init_randr, format_gamma, apply_gamma
+
 # --- Configuration (User MUST edit these values) ---
 # Find your latitude and longitude online (e.g., Google Maps)
 LATITUDE = 37.7749  # Example: San Francisco, CA
@@ -23,168 +24,211 @@ TRANSITION_MINUTES = 60
 
 # Interval for checking and applying color changes (in seconds)
 CHECK_INTERVAL_SECONDS = 60 
+
+# Longest sleep during the flat Day/Night phases (in seconds). time.sleep()
+# does not count time spent suspended, so keep this short enough to catch up
+# soon after resume.
+MAX_SLEEP_SECONDS = 900
+
+# Transition temperatures are rounded to this many Kelvin; smaller steps are not visible
+TEMP_STEP_K = 50
 # ---------------------------------------------------
 
 
-# --- Core Kelvin to RGB Gamma Conversion Logic (Reused) ---
+# --- New Daemon Logic ---
+
+# Sunrise/sunset as Unix timestamps keyed by local date, so sun() only runs
+# when the date rolls over
+_sun_cache = {}
+
+def _compute_sun_times(observer, location_tz, day):
+    """Runs astral's sun() for a local date and returns (sunrise_ts, sunset_ts)."""
+    times = sun(observer, date=day, tzinfo=location_tz)
+    return times['sunrise'].timestamp(), times['sunset'].timestamp()
+
+def _evict_sun_times_before(day):
+    """Drops cached sun times for dates earlier than the given one."""
+    for old_day in [old_day for old_day in _sun_cache if old_day < day]:
+        del _sun_cache[old_day]
 
-def kelvin_to_rgb_gamma(temp_k):
+def _sun_times(observer, location_tz, day):
     """
-    Converts a color temperature in Kelvin (K) to R, G, B gamma correction values
-    suitable for the 'xrandr --gamma R:G:B' command. (Same as original implementation)
+    Returns (sunrise_ts, sunset_ts) for a local date, computing it with astral
+    only if it isn't cached yet. Entries for earlier dates are evicted.
     """
-    temp_k = float(temp_k)
-
-    min_k = 1000.0
-    max_k = 6500.0
-    
-    if temp_k >= max_k:
-        return 1.0, 1.0, 1.0
-    if temp_k <= min_k:
-        temp_k = min_k
-
-    # --- Red Gamma Calculation ---
-    red = 1.0
-
-    # --- Green Gamma Calculation ---
-    if temp_k >= 5000.0:
-        green = 0.8 + 0.2 * ((temp_k - 5000.0) / 1500.0)
-    elif temp_k >= 2000.0:
-        green = 0.6 + 0.3 * ((temp_k - 2000.0) / 3000.0)
-    else:
-        green = 0.6 - 0.1 * ((2000.0 - temp_k) / 1000.0)
-    
-    green = max(0.5, min(1.0, green))
-
-    # --- Blue Gamma Calculation ---
-    if temp_k >= 6000.0:
-        blue = 0.8 + 0.2 * ((temp_k - 6000.0) / 500.0)
-    elif temp_k >= 3000.0:
-        blue = 0.3 + 0.5 * ((temp_k - 3000.0) / 3000.0)
-    else:
-        blue = 0.3 * ((temp_k - 1000.0) / 2000.0)
-        
-    blue = max(0.0, min(1.0, blue))
-    
-    return red, green, blue
+    cached = _sun_cache.get(day)
+    if cached is None:
+        _evict_sun_times_before(day)
+        cached = _sun_cache.setdefault(day, _compute_sun_times(observer, location_tz, day))
+    return cached
 
+def _preload_next_day(observer, location_tz):
+    """
+    Computes tomorrow's sun times ahead of time, so the first check after
+    midnight is a cache hit instead of a fresh sun() calculation. Also evicts
+    past dates, since with the preload in place today is never a cache miss.
+    """
+    today = datetime.now(location_tz).date()
+    _evict_sun_times_before(today)
+    tomorrow = today + timedelta(days=1)
+    if tomorrow not in _sun_cache:
+        try:
+            _sun_cache[tomorrow] = _compute_sun_times(observer, location_tz, tomorrow)
+        except Exception:
+            pass # calculate_target_temp reports sun errors when the day arrives
 
-# --- Utility Functions for xrandr Interaction (Reused) ---
+# (phase, temp_k) of the last status line printed
+_last_logged = None
 
-def get_connected_displays():
-    """Uses xrandr to find all connected display names."""
-    try:
-        result = subprocess.run(['xrandr'], capture_output=True, text=True, check=True)
-        output = result.stdout
-        connected_displays = re.findall(r'^(\S+)\s+connected', output, re.MULTILINE)
-        return connected_displays
-    except Exception as e:
-        print(f"Error accessing xrandr: {e}. The program cannot run without xrandr.")
-        sys.exit(1)
+def _should_log(phase, temp_k):
+    """
+    Returns True if a status line for this phase/temperature should be printed,
+    i.e. it differs from the previous one. Repeats during the long Day and
+    Night phases are skipped before any formatting happens.
+    """
+    global _last_logged
+    if _last_logged == (phase, temp_k):
+        return False
+    _last_logged = (phase, temp_k)
+    return True
 
-def apply_gamma(display, r, g, b):
-    """Applies the given R:G:B gamma values to a specific display using xrandr."""
-    gamma_value = f"{r:.4f}:{g:.4f}:{b:.4f}"
-    cmd = ['xrandr', '--output', display, '--gamma', gamma_value]
-    
+def _system_timezone():
+    """
+    The system's local zone, with its DST rules. astimezone() alone only
+    gives the current fixed UTC offset, which is wrong after a DST change.
+    """
     try:
-        subprocess.run(cmd, check=True, capture_output=True)
-    except subprocess.CalledProcessError as e:
-        # Suppress constant logging if xrandr fails for a non-critical reason
-        # print(f"Warning: Failed to set gamma for {display}. Error: {e.stderr.decode().strip()}")
-        pass
-    except Exception as e:
-        print(f"An unexpected error occurred while setting gamma for {display}: {e}")
-        pass
+        with open('/etc/localtime', 'rb') as f:
+            return ZoneInfo.from_file(f, key='localtime')
+    except (OSError, ValueError):
+        return datetime.now().astimezone().tzinfo
 
+def _seconds_until(now_ts, boundary_ts):
+    """Seconds from now until a phase boundary, capped to MAX_SLEEP_SECONDS."""
+    return max(1.0, min(boundary_ts - now_ts, MAX_SLEEP_SECONDS))
 
-# --- New Daemon Logic ---
-
-def calculate_target_temp(location_info):
+def _calculate_ramp_temp(observer, location_tz, _day=DAY_TEMP, _night=NIGHT_TEMP, _trans=TRANSITION_MINUTES):
     """
     Calculates the current target Kelvin temperature based on the time of day 
     relative to sunrise and sunset.
+
+    Args:
+        observer (astral.Observer): The location's observer, resolved once at startup.
+        location_tz (tzinfo): The location's timezone, resolved once at startup.
+        _day, _night, _trans: DAY_TEMP, NIGHT_TEMP and TRANSITION_MINUTES bound
+            as defaults so they are fast local lookups; not meant to be passed.
+
+    Returns:
+        tuple: (temp_k, sleep_s) where sleep_s is how long the caller can sleep
+        before the target can change (CHECK_INTERVAL_SECONDS during transitions,
+        up to the next phase boundary during the Day and Night phases).
     """
+    now = datetime.now(location_tz)
+    now_ts = now.timestamp()
+
     try:
-        # Get today's sun times in the specified timezone
-        today_sun = sun(location_info.observer, date=datetime.now(), tzinfo=location_info.timezone)
-        
-        sunrise = today_sun['sunrise']
-        sunset = today_sun['sunset']
+        # Get today's sun times in the specified timezone (cached per day)
+        sunrise, sunset = _sun_times(observer, location_tz, now.date())
 
     except Exception as e:
         print(f"Error calculating sun times (check TIMEZONE and coordinates): {e}")
         # Fallback to daytime temp if sun calculation fails
-        return DAY_TEMP 
-
-    # FIX: Convert the timezone string into a tzinfo object using dateutil.tz
-    try:
-        location_tz = tz.gettz(location_info.timezone)
-        if location_tz is None:
-             # If tz.gettz fails to find the timezone, use a fallback
-             print(f"Warning: Timezone '{location_info.timezone}' not recognized. Using system time.")
-             now = datetime.now() 
-        else:
-             now = datetime.now(location_tz)
-    except Exception as e:
-        print(f"Warning: Could not localize current time: {e}. Using system time.")
-        now = datetime.now() # Fallback to naive datetime if localization fails
+        return _day, CHECK_INTERVAL_SECONDS
 
+    # All boundaries are Unix timestamps, so the checks below are float compares
+    transition_s = _trans * 60
 
     # 1. NIGHT PHASE (Sunset + Transition period to Sunrise)
     # Night begins after the transition period ends
-    night_start = sunset + timedelta(minutes=TRANSITION_MINUTES)
+    night_start = sunset + transition_s
     
     # 2. MORNING TRANSITION (Sunrise - Transition period to Sunrise)
     # The smooth transition up starts TRANSITION_MINUTES before sunrise
-    morning_transition_start = sunrise - timedelta(minutes=TRANSITION_MINUTES)
+    morning_transition_start = sunrise - transition_s
     
     # 3. EVENING TRANSITION (Sunset - Transition period to Sunset)
     # The smooth transition down starts TRANSITION_MINUTES before sunset
-    evening_transition_start = sunset - timedelta(minutes=TRANSITION_MINUTES)
+    evening_transition_start = sunset - transition_s
 
     # --- Nighttime ---
     # This handles the time from night_start (after sunset fade) until morning_transition_start (before sunrise fade)
-    if now >= night_start or now < morning_transition_start:
-        print(f"[{now.strftime('%H:%M:%S')}] Night: Set to {NIGHT_TEMP}K.")
-        return NIGHT_TEMP
+    if now_ts >= night_start or now_ts < morning_transition_start:
+        if _should_log('Night', _night):
+            print(f"[{now.strftime('%H:%M:%S')}] Night: Set to {_night}K.")
+        if now_ts < morning_transition_start:
+            return _night, _seconds_until(now_ts, morning_transition_start)
+        # After tonight's fade the next boundary is tomorrow morning
+        return _night, MAX_SLEEP_SECONDS
 
     # --- Day Time ---
     # This handles the time from sunrise until evening_transition_start
-    if now >= sunrise and now < evening_transition_start:
-        print(f"[{now.strftime('%H:%M:%S')}] Day: Set to {DAY_TEMP}K.")
-        return DAY_TEMP
+    if now_ts >= sunrise and now_ts < evening_transition_start:
+        if _should_log('Day', _day):
+            print(f"[{now.strftime('%H:%M:%S')}] Day: Set to {_day}K.")
+        return _day, _seconds_until(now_ts, evening_transition_start)
     
     # --- Evening Transition (Fading down from DAY_TEMP to NIGHT_TEMP) ---
-    if now >= evening_transition_start and now < night_start:
-        total_span = TRANSITION_MINUTES * 2 # Transition happens over a 2x span (before sunset to after sunset)
-        elapsed_time = now - evening_transition_start
+    if now_ts >= evening_transition_start and now_ts < night_start:
+        total_span = _trans * 2 # Transition happens over a 2x span (before sunset to after sunset)
+        elapsed_s = now_ts - evening_transition_start
         
         # Calculate ratio (0.0 at start of transition, 1.0 at night_start)
-        ratio = elapsed_time.total_seconds() / (total_span * 60)
+        ratio = elapsed_s / (total_span * 60)
         ratio = max(0.0, min(1.0, ratio)) # Clamp between 0 and 1
 
         # Interpolate: DAY_TEMP * (1-ratio) + NIGHT_TEMP * ratio
-        temp = DAY_TEMP * (1 - ratio) + NIGHT_TEMP * ratio
-        print(f"[{now.strftime('%H:%M:%S')}] Fading Down: {int(temp)}K (Ratio: {ratio:.2f})")
-        return temp
+        temp = _day * (1 - ratio) + _night * ratio
+        temp = round(temp / TEMP_STEP_K) * TEMP_STEP_K
+        if _should_log('Fading Down', temp):
+            print(f"[{now.strftime('%H:%M:%S')}] Fading Down: {int(temp)}K (Ratio: {ratio:.2f})")
+        return temp, CHECK_INTERVAL_SECONDS
 
     # --- Morning Transition (Fading up from NIGHT_TEMP to DAY_TEMP) ---
-    if now >= morning_transition_start and now < sunrise:
-        total_span = TRANSITION_MINUTES # Morning transition only runs until sunrise
-        elapsed_time = now - morning_transition_start
+    if now_ts >= morning_transition_start and now_ts < sunrise:
+        total_span = _trans # Morning transition only runs until sunrise
+        elapsed_s = now_ts - morning_transition_start
         
         # Calculate ratio (0.0 at start of transition, 1.0 at sunrise)
-        ratio = elapsed_time.total_seconds() / (total_span * 60)
+        ratio = elapsed_s / (total_span * 60)
         ratio = max(0.0, min(1.0, ratio)) # Clamp between 0 and 1
         
         # Interpolate: NIGHT_TEMP * (1-ratio) + DAY_TEMP * ratio
-        temp = NIGHT_TEMP * (1 - ratio) + DAY_TEMP * ratio
-        print(f"[{now.strftime('%H:%M:%S')}] Fading Up: {int(temp)}K (Ratio: {ratio:.2f})")
-        return temp
+        temp = _night * (1 - ratio) + _day * ratio
+        temp = round(temp / TEMP_STEP_K) * TEMP_STEP_K
+        if _should_log('Fading Up', temp):
+            print(f"[{now.strftime('%H:%M:%S')}] Fading Up: {int(temp)}K (Ratio: {ratio:.2f})")
+        return temp, CHECK_INTERVAL_SECONDS
 
     # Should not happen, but serves as a safe fallback
-    return DAY_TEMP 
+    return _day, CHECK_INTERVAL_SECONDS
+
+def _calculate_step_temp(observer, location_tz, _day=DAY_TEMP, _night=NIGHT_TEMP):
+    """
+    Variant of _calculate_ramp_temp for TRANSITION_MINUTES == 0: the
+    temperature switches directly at sunrise and sunset, with no fade.
+    """
+    now = datetime.now(location_tz)
+    now_ts = now.timestamp()
+
+    try:
+        sunrise, sunset = _sun_times(observer, location_tz, now.date())
+    except Exception as e:
+        print(f"Error calculating sun times (check TIMEZONE and coordinates): {e}")
+        return _day, CHECK_INTERVAL_SECONDS
+
+    if now_ts >= sunrise and now_ts < sunset:
+        if _should_log('Day', _day):
+            print(f"[{now.strftime('%H:%M:%S')}] Day: Set to {_day}K.")
+        return _day, _seconds_until(now_ts, sunset)
+
+    if _should_log('Night', _night):
+        print(f"[{now.strftime('%H:%M:%S')}] Night: Set to {_night}K.")
+    if now_ts < sunrise:
+        return _night, _seconds_until(now_ts, sunrise)
+    return _night, MAX_SLEEP_SECONDS
+
+# The configuration is fixed at load time, so pick the matching implementation once
+calculate_target_temp = _calculate_step_temp if TRANSITION_MINUTES == 0 else _calculate_ramp_temp
 
 def main_loop():
     """
@@ -197,34 +241,70 @@ def main_loop():
     except Exception as e:
         print(f"CRITICAL ERROR: Failed to create LocationInfo. Check your TIMEZONE and coordinates: {e}")
         sys.exit(1)
+
+    # Convert the timezone string into a tzinfo object once (ZoneInfo instances are cached)
+    try:
+        location_tz = ZoneInfo(TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        print(f"Warning: Timezone '{TIMEZONE}' not recognized. Using system time.")
+        location_tz = _system_timezone()
+    observer = location.observer
         
     # 2. Get displays once
     displays = get_connected_displays()
+    if isinstance(displays, str):
+        print(f"Error accessing xrandr ({displays}). The program cannot run without xrandr.")
+        sys.exit(1)
     if not displays:
         print("No connected displays found. Exiting.")
         sys.exit(0)
 
+    # Set gamma over one persistent X connection instead of spawning xrandr, if possible
+    use_randr = init_randr(displays)
+
     print(f"PyFlux Daemon started.")
     print(f"Monitoring displays: {', '.join(displays)}")
+    print(f"Gamma backend: {'RandR (xcffib)' if use_randr else 'xrandr'}")
     print(f"Location: {CITY_NAME} ({LATITUDE:.2f}, {LONGITUDE:.2f})")
     print("-" * 30)
 
+    # The work is best-effort background housekeeping; don't compete with
+    # interactive processes for the CPU
+    try:
+        os.nice(19)
+        if hasattr(os, 'SCHED_IDLE'):
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except OSError as e:
+        print(f"Warning: Could not lower daemon priority: {e}")
+
     # 3. Main loop
+    last_gamma = None # Last gamma string applied to the displays
     while True:
         try:
-            target_temp = calculate_target_temp(location)
+            target_temp, sleep_s = calculate_target_temp(observer, location_tz)
             r, g, b = kelvin_to_rgb_gamma(target_temp)
             
-            for display in displays:
-                apply_gamma(display, r, g, b)
+            # One batched update for all displays, skipped when the value at
+            # its 4-decimal precision is unchanged
+            gamma_value = format_gamma(r, g, b)
+            # Suppress constant logging if xrandr fails for a non-critical reason
+            if gamma_value != last_gamma and apply_gamma(displays, gamma_value, quiet=True):
+                last_gamma = gamma_value
+
+            # Off the critical path: have tomorrow's sun times ready at midnight
+            _preload_next_day(observer, location_tz)
             
-            time.sleep(CHECK_INTERVAL_SECONDS)
+            time.sleep(sleep_s)
+
+            # After a long Day/Night sleep, reapply even an unchanged value: the
+            # ramps may have been reset meanwhile (resume, VT switch, hotplug)
+            if sleep_s > CHECK_INTERVAL_SECONDS:
+                last_gamma = None
 
         except KeyboardInterrupt:
             print("\nPyFlux Daemon stopped by user.")
             # Optional: Reset gamma to default before exiting
-            # for display in displays:
-            #     apply_gamma(display, 1.0, 1.0, 1.0)
+            # apply_gamma(displays, format_gamma(1.0, 1.0, 1.0))
             break
         except Exception as e:
             print(f"An unexpected error occurred in the main loop: {e}")
@@ -232,12 +312,4 @@ def main_loop():
 
 
 if __name__ == '__main__':
-    # Make sure 'python-dateutil' is installed
-    try:
-        import dateutil.tz
-    except ImportError:
-        print("CRITICAL ERROR: The 'python-dateutil' library is required for timezone handling.")
-        print("Please install it using: pip install python-dateutil")
-        sys.exit(1)
-
     main_loop()
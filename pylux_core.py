@@ -0,0 +1,295 @@
+import shutil
+import subprocess
+from array import array
+from functools import lru_cache
+
+# Optional: talk RandR directly over XCB instead of spawning xrandr
+try:
+    import xcffib
+    import xcffib.randr
+except ImportError:
+    xcffib = None
+
+
+# --- Core Kelvin to RGB Gamma Conversion Logic (Shared by main.py and pyflux_daemon.py) ---
+
+def _compute_rgb_gamma(temp_k):
+    """Evaluates the piecewise Kelvin to R:G:B gamma curve directly."""
+    temp_k = float(temp_k)
+
+    # Clamp the temperature to a practical range for screen correction
+    min_k = 1000.0
+    max_k = 6500.0
+    
+    if temp_k >= max_k:
+        return 1.0, 1.0, 1.0
+    if temp_k <= min_k:
+        temp_k = min_k # Ensure the calculation doesn't fail below min
+
+    # --- Red Gamma Calculation (Red is clamped high for the warming effect) ---
+    red = 1.0
+
+    # --- Green Gamma Calculation ---
+    if temp_k >= 5000.0:
+        # Linear fade from 1.0 at 6500K to ~0.9 at 5000K
+        green = 0.8 + 0.2 * ((temp_k - 5000.0) / 1500.0)
+    elif temp_k >= 2000.0:
+        # Linear fade from ~0.9 at 5000K to ~0.6 at 2000K
+        green = 0.6 + 0.3 * ((temp_k - 2000.0) / 3000.0)
+    else:
+        # Below 2000K, clamp near min
+        green = 0.6 - 0.1 * ((2000.0 - temp_k) / 1000.0)
+    
+    green = max(0.5, min(1.0, green)) # Clamp between 0.5 and 1.0
+
+    # --- Blue Gamma Calculation (Blue drops most significantly) ---
+    if temp_k >= 6000.0:
+        # Linear fade from 1.0 at 6500K to 0.9 at 6000K
+        blue = 0.8 + 0.2 * ((temp_k - 6000.0) / 500.0)
+    elif temp_k >= 3000.0:
+        # Linear fade from ~0.8 at 6000K to ~0.3 at 3000K
+        blue = 0.3 + 0.5 * ((temp_k - 3000.0) / 3000.0)
+    else:
+        # Below 3000K, clamp near min
+        blue = 0.3 * ((temp_k - 1000.0) / 2000.0)
+        
+    blue = max(0.0, min(1.0, blue)) # Clamp between 0.0 and 1.0
+    
+    return red, green, blue
+
+
+# Every integer Kelvin value in the supported range, evaluated once at import
+_GAMMA_LUT = tuple(_compute_rgb_gamma(k) for k in range(1000, 6501))
+
+
+def kelvin_to_rgb_gamma(temp_k):
+    """
+    Converts a color temperature in Kelvin (K) to R, G, B gamma correction values
+    suitable for the 'xrandr --gamma R:G:B' command.
+
+    This uses a simplified, practical algorithm derived from the Planckian Locus 
+    to create a smooth transition from cool (daylight) to warm (night light) 
+    colors, optimized for the screen's gamma ramp (0.0 to 1.0).
+
+    Args:
+        temp_k (int/float): The desired color temperature in Kelvin (e.g., 6500, 3000).
+
+    Returns:
+        tuple: (red_gamma, green_gamma, blue_gamma) as floats between 0.0 and 1.0.
+    """
+    k = int(temp_k)
+    if k != temp_k:
+        # Non-integer input: evaluate the curve directly
+        return _compute_rgb_gamma(temp_k)
+
+    if k >= 6500:
+        return 1.0, 1.0, 1.0
+    if k < 1000:
+        k = 1000
+    return _GAMMA_LUT[k - 1000]
+
+
+# --- Utility Functions for xrandr Interaction (Shared) ---
+
+def get_connected_displays():
+    """
+    Uses xrandr to find all connected display names (e.g., 'eDP-1', 'HDMI-A-1').
+    """
+    try:
+        # Ask only for the active monitors; lines look like
+        # ' 0: +*eDP-1 1920/344x1080/194+0+0  eDP-1' (monitor name, geometry, then
+        # its outputs; a tiled or --setmonitor monitor lists several, or none)
+        connected_displays = []
+        try:
+            result = subprocess.run(['xrandr', '--listactivemonitors'], capture_output=True, text=True, check=True)
+            for line in result.stdout.splitlines():
+                tokens = line.split()
+                if len(tokens) >= 2 and tokens[0][:-1].isdigit() and tokens[0].endswith(':'):
+                    for output in tokens[3:]:
+                        if output not in connected_displays:
+                            connected_displays.append(output)
+        except subprocess.CalledProcessError:
+            pass # Older xrandr without --listactivemonitors
+
+        if not connected_displays:
+            # Fall back to the full xrandr output
+            result = subprocess.run(['xrandr'], capture_output=True, text=True, check=True)
+            output = result.stdout
+
+            # Lines look like 'eDP-1 connected primary 1920x1080+0+0 ...'
+            for line in output.splitlines():
+                tokens = line.split()
+                if len(tokens) >= 2 and tokens[1] == 'connected':
+                    connected_displays.append(tokens[0])
+        
+        if not connected_displays:
+            return None
+        return connected_displays
+    
+    except FileNotFoundError:
+        return 'XRANDR_NOT_FOUND'
+    except subprocess.CalledProcessError:
+        return 'XRANDR_ERROR'
+    except Exception:
+        return 'UNKNOWN_ERROR'
+
+
+# --- Direct RandR Gamma (used when xcffib is installed) ---
+
+_randr_conn = None
+_randr_crtcs = {} # Output name -> (crtc id, gamma ramp size)
+
+def _close_randr():
+    """Drops the cached X connection, so apply_gamma goes back to xrandr."""
+    global _randr_conn
+    if _randr_conn is not None:
+        try:
+            _randr_conn.disconnect()
+        except Exception:
+            pass
+        _randr_conn = None
+        _randr_crtcs.clear()
+
+def init_randr(displays, quiet=False):
+    """
+    Opens one X connection and caches the CRTC of each given display so gamma
+    can be set in-process. Returns True if every display can use this path.
+    """
+    global _randr_conn
+    if xcffib is None:
+        return False
+
+    # Drop any previous connection; its CRTC mapping may be stale
+    _close_randr()
+
+    try:
+        conn = xcffib.connect()
+        randr = conn(xcffib.randr.key)
+        root = conn.get_setup().roots[conn.pref_screen].root
+        resources = randr.GetScreenResourcesCurrent(root).reply()
+
+        crtcs = {}
+        for output in resources.outputs:
+            info = randr.GetOutputInfo(output, resources.config_timestamp).reply()
+            if info.connection != xcffib.randr.Connection.Connected or not info.crtc:
+                continue
+            size = randr.GetCrtcGammaSize(info.crtc).reply().size
+            crtcs[bytes(info.name).decode()] = (info.crtc, size)
+    except Exception as e:
+        if not quiet:
+            print(f"RandR unavailable, falling back to xrandr: {e}")
+        return False
+
+    if not all(display in crtcs for display in displays):
+        conn.disconnect()
+        return False
+
+    _randr_conn = conn
+    _randr_crtcs.update(crtcs)
+    return True
+
+# Enough for the green and blue ramps of every step of a 100-step fade
+@lru_cache(maxsize=256)
+def _gamma_ramp(gamma_str, size):
+    """
+    Builds a gamma ramp the same way 'xrandr --gamma' does. Cached on the
+    4-decimal component string, so repeated values reuse the same ramp.
+    Stored as a uint16 array (2 bytes per entry), the format SetCrtcGamma sends.
+    """
+    gamma = float(gamma_str)
+    exponent = 1.0 / gamma if gamma > 0 else float('inf')
+    return array('H', (int(min((i / (size - 1)) ** exponent, 1.0) * 65535) for i in range(size)))
+
+def _apply_gamma_randr(displays, gamma_value):
+    """
+    Sets the gamma of each display's CRTC over the cached X connection. The
+    requests are checked, so X errors (e.g. a CRTC that went away) raise here.
+    """
+    r, g, b = gamma_value.split(':')
+    randr = _randr_conn(xcffib.randr.key)
+    cookies = []
+    for display in displays:
+        crtc, size = _randr_crtcs[display]
+        cookies.append(randr.SetCrtcGammaChecked(
+            crtc, size, _gamma_ramp(r, size), _gamma_ramp(g, size), _gamma_ramp(b, size)
+        ))
+    for cookie in cookies:
+        cookie.check()
+
+
+# Absolute path of xrandr, resolved once. CPython only takes its posix_spawn
+# fast path for commands given with a directory component.
+_XRANDR = shutil.which('xrandr') or 'xrandr'
+
+def format_gamma(r, g, b):
+    """Formats R, G, B gamma values as the 'R:G:B' string xrandr expects."""
+    return f"{r:.4f}:{g:.4f}:{b:.4f}"
+
+def _run_xrandr_gamma(displays, gamma_value):
+    """Sets the gamma of the given displays with one xrandr invocation."""
+    cmd = [_XRANDR]
+    for display in displays:
+        cmd += ['--output', display, '--gamma', gamma_value]
+
+    # Execute the xrandr command. With an absolute path and close_fds=False
+    # CPython uses posix_spawn instead of fork + closing every inherited fd.
+    # xrandr prints nothing on success, so only stderr is piped.
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, close_fds=False)
+
+def apply_gamma(displays, gamma_value, quiet=False):
+    """
+    Applies an 'R:G:B' gamma string to all given displays, either directly
+    through RandR (see init_randr) or with a single xrandr invocation
+    (one '--output X --gamma R:G:B' clause per display). If that invocation
+    fails, the displays are retried one at a time, so an output that went
+    away (e.g. after undocking) does not keep the others from updating.
+
+    Returns True if at least one display was updated. With quiet=True
+    failures are not reported, for callers that retry on every check.
+    """
+    if _randr_conn is not None:
+        try:
+            _apply_gamma_randr(displays, gamma_value)
+            return True
+        except Exception as e:
+            # Outputs may have moved to other CRTCs (hotplug, mode change):
+            # re-resolve them once
+            if not quiet:
+                print(f"RandR gamma update failed, re-resolving outputs: {e}")
+            try:
+                if init_randr(displays, quiet):
+                    _apply_gamma_randr(displays, gamma_value)
+                    return True
+            except Exception as e:
+                if not quiet:
+                    print(f"RandR gamma update failed again: {e}")
+            # Still failing: use xrandr from now on rather than reconnecting
+            # on every update
+            _close_randr()
+            if not quiet:
+                print("Switching to xrandr.")
+
+    try:
+        _run_xrandr_gamma(displays, gamma_value)
+        return True
+    except subprocess.CalledProcessError as e:
+        if len(displays) == 1:
+            if not quiet:
+                print(f"Failed to set gamma for {displays[0]}. Error: {e.stderr.decode().strip()}")
+            return False
+    except Exception as e:
+        print(f"An unexpected error occurred while setting gamma for {', '.join(displays)}: {e}")
+        return False
+
+    # xrandr rejects the whole batch if any one output is gone or disabled
+    applied = False
+    for display in displays:
+        try:
+            _run_xrandr_gamma([display], gamma_value)
+            applied = True
+        except subprocess.CalledProcessError as e:
+            if not quiet:
+                print(f"Failed to set gamma for {display}. Error: {e.stderr.decode().strip()}")
+        except Exception as e:
+            print(f"An unexpected error occurred while setting gamma for {display}: {e}")
+    return applied